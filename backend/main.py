@@ -1,11 +1,17 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 import os
-import shutil
+import re
+import asyncio
+import hashlib
+import sqlite3
+from contextlib import asynccontextmanager, closing
 from datetime import datetime
 import uuid
-import PyPDF2
+import aiofiles
+import fitz  # PyMuPDF
 import docx
 from typing import List, Optional, Dict
 import google.generativeai as genai
@@ -16,7 +22,13 @@ from dotenv import load_dotenv
 
 warnings.filterwarnings('ignore')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resolve the stacking factor once, so /analyze_batch/ never waits on the lookup
+    app.state.docs_per_batch = await run_in_threadpool(get_docs_per_batch)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -30,9 +42,16 @@ app.add_middleware(
 # Configure upload settings
 UPLOAD_DIR = "uploads"
 ALLOWED_EXTENSIONS = {".pdf", ".doc", ".docx", ".txt"}
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB per read/write while streaming uploads
+
+# Uploaded content is stored once per hash; each file_id is a hardlink to it
+CONTENT_DIR = os.path.join(UPLOAD_DIR, "by-hash")
 
-# Ensure upload directory exists
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Ensure upload directories exist
+os.makedirs(CONTENT_DIR, exist_ok=True)
+
+# Configure analysis cache (kept outside UPLOAD_DIR so /files/ doesn't list it)
+CACHE_DB = "analysis_cache.db"
 
 load_dotenv()
 # Configure Google AI Studio
@@ -43,13 +62,18 @@ if not GOOGLE_API_KEY:
 genai.configure(api_key=GOOGLE_API_KEY)
 
 # Configure the model
+MODEL_NAME = "gemini-pro"
+MAX_OUTPUT_TOKENS = 2048
+BATCH_SIZE = 4  # most documents stacked into a single Gemini prompt by /analyze_batch/
+MAX_BATCH_FILES = 20  # file_ids accepted by one /analyze_batch/ request
+
 model = genai.GenerativeModel(
-    model_name="gemini-pro",
+    model_name=MODEL_NAME,
     generation_config={
         "temperature": 0.7,
         "top_p": 0.9,
         "top_k": 40,
-        "max_output_tokens": 2048,
+        "max_output_tokens": MAX_OUTPUT_TOKENS,
     },
     safety_settings={
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -95,18 +119,143 @@ async def generate_gemini_response(prompt: str) -> str:
     except Exception as e:
         raise Exception(f"Error in Gemini inference: {str(e)}")
 
+_DOC_RESPONSE_RE = re.compile(r"^[\s#*]*DOC (\d+) RESPONSE\b.*$", re.IGNORECASE | re.MULTILINE)
+
+def get_docs_per_batch() -> int:
+    """Work out how many documents fit in one response at a single request's budget."""
+    try:
+        output_token_limit = genai.get_model(f"models/{MODEL_NAME}").output_token_limit
+    except Exception as e:
+        print(f"Could not look up output token limit, disabling stacking: {str(e)}")
+        return 1
+    # gemini-pro caps output at MAX_OUTPUT_TOKENS, which means no stacking at all
+    return max(1, min(BATCH_SIZE, output_token_limit // MAX_OUTPUT_TOKENS))
+
+def is_truncated(response) -> bool:
+    """Check whether Gemini stopped because it ran out of output tokens."""
+    return response.candidates[0].finish_reason.name == "MAX_TOKENS"
+
+async def generate_gemini_batch(prompts: List[str]) -> List[Optional[str]]:
+    """Generate responses for several documents with a single Gemini call.
+
+    Documents the model skipped or didn't finish come back as None.
+    """
+    try:
+        documents = '\n\n'.join(
+            f"### DOC {number}\n{prompt}" for number, prompt in enumerate(prompts, 1)
+        )
+        formatted_prompt = f"""You are an expert government policy analyst. 
+        Analyze each of the {len(prompts)} documents below independently and provide a structured opinion for each:
+
+        {documents}
+
+        For each document, start its answer with the line "### DOC <number> RESPONSE"
+        and format it with clear section headers:
+        - Executive Summary
+        - Key Points
+        - Recommendations
+        - Risks
+        - Next Steps"""
+
+        # Batches are sized so every document gets a single request's budget
+        response = await model.generate_content_async(
+            formatted_prompt,
+            generation_config={"max_output_tokens": MAX_OUTPUT_TOKENS * len(prompts)}
+        )
+        responses = split_batch_response(response.text, len(prompts))
+
+        # Output cut off at the token limit leaves the last answered document incomplete
+        if is_truncated(response):
+            answered = [i for i, text in enumerate(responses) if text is not None]
+            if answered:
+                responses[answered[-1]] = None
+        return responses
+
+    except Exception as e:
+        raise Exception(f"Error in Gemini batch inference: {str(e)}")
+
+def split_batch_response(content: str, count: int) -> List[Optional[str]]:
+    """Split a stacked response into per-document responses, in prompt order."""
+    matches = list(_DOC_RESPONSE_RE.finditer(content))
+    responses = {}
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        end = next_match.start() if next_match else len(content)
+        text = content[match.end():end]
+        if text.strip():
+            responses[int(match.group(1))] = text
+    return [responses.get(number) for number in range(1, count + 1)]
+
+def init_analysis_cache() -> None:
+    """Create the analysis cache table if it doesn't exist."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn, conn:
+        # WAL lets concurrent requests read while another one writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "file_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, upload_time TEXT NOT NULL)"
+        )
+
+def record_upload(file_id: str, content_hash: str, upload_time: str) -> None:
+    """Remember which content an upload points to and when it arrived."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO uploads (file_id, content_hash, upload_time) VALUES (?, ?, ?)",
+            (file_id, content_hash, upload_time)
+        )
+
+def get_upload_times() -> Dict[str, str]:
+    """Return the recorded upload time of every file_id."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn:
+        return dict(conn.execute("SELECT file_id, upload_time FROM uploads"))
+
+def get_content_hash(file_path: str) -> str:
+    """Look up the content hash recorded at upload, hashing the file if there is none."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn:
+        row = conn.execute(
+            "SELECT content_hash FROM uploads WHERE file_id = ?", (os.path.basename(file_path),)
+        ).fetchone()
+    if row:
+        return row[0]
+
+    file_hash = hashlib.blake2b()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_cache_key(file_path: str) -> str:
+    """Build the cache key from the file contents and the model that analyzes them."""
+    return f"{get_content_hash(file_path)}|{MODEL_NAME}"
+
+def get_cached_analysis(key: str) -> Optional[AnalysisResponse]:
+    """Return a previously stored analysis, if any."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn:
+        row = conn.execute(
+            "SELECT result FROM analysis_cache WHERE key = ?", (key,)
+        ).fetchone()
+    return AnalysisResponse.model_validate_json(row[0]) if row else None
+
+def store_cached_analysis(key: str, analysis: AnalysisResponse) -> None:
+    """Persist an analysis so repeated requests for the same content skip Gemini."""
+    with closing(sqlite3.connect(CACHE_DB)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_cache (key, result) VALUES (?, ?)",
+            (key, analysis.model_dump_json())
+        )
+
+init_analysis_cache()
+
 def extract_text_from_file(file_path: str) -> str:
     """Extract text content from different file types."""
     file_ext = os.path.splitext(file_path)[1].lower()
 
     try:
         if file_ext == '.pdf':
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text = ''
-                for page in pdf_reader.pages:
-                    text += page.extract_text()
-                return text
+            with fitz.open(file_path) as pdf:
+                return '\n'.join(page.get_text() for page in pdf)
 
         elif file_ext in ['.doc', '.docx']:
             doc = docx.Document(file_path)
@@ -129,21 +278,103 @@ async def analyze_text(text: str) -> AnalysisResponse:
         # Generate response using Gemini
         gemini_response = await generate_gemini_response(text)
 
-        # Parse the response
-        sections = parse_ai_response(gemini_response)
-
-        return AnalysisResponse(
-            summary=sections['summary'],
-            key_points=sections['key_points'],
-            recommendations=sections['recommendations'],
-            confidence_score=calculate_confidence(sections),
-            risks=sections['risks'],
-            next_steps=sections['next_steps']
-        )
+        return build_analysis(gemini_response)
 
     except Exception as e:
         raise Exception(f"Error in document analysis: {str(e)}")
 
+async def analyze_texts(texts: List[str]) -> List[AnalysisResponse]:
+    """Analyze several documents, stacking as many per Gemini call as the output cap allows."""
+    try:
+        docs_per_batch = app.state.docs_per_batch
+        batches = [texts[i:i + docs_per_batch] for i in range(0, len(texts), docs_per_batch)]
+
+        async def generate_batch(batch: List[str]) -> List[Optional[str]]:
+            if len(batch) == 1:
+                # Nothing to stack; analyze_text sends it as a single request
+                return [None]
+            try:
+                return await generate_gemini_batch(batch)
+            except Exception as e:
+                # e.g. stacked input over the model's limit or a blocked candidate
+                print(f"Batch failed, analyzing its documents one by one: {str(e)}")
+                return [None] * len(batch)
+
+        batch_responses = await asyncio.gather(*(generate_batch(batch) for batch in batches))
+        gemini_responses = [response for batch in batch_responses for response in batch]
+
+        async def analyze_one(text: str, gemini_response: Optional[str]) -> AnalysisResponse:
+            if gemini_response is None:
+                # Missing, truncated or failed in the batch; fall back to a single request
+                return await analyze_text(text)
+            return build_analysis(gemini_response)
+
+        return list(await asyncio.gather(
+            *(analyze_one(text, response) for text, response in zip(texts, gemini_responses))
+        ))
+
+    except Exception as e:
+        raise Exception(f"Error in batch document analysis: {str(e)}")
+
+def is_complete(analysis: AnalysisResponse) -> bool:
+    """Check that every section was filled in, so the result is safe to cache."""
+    return bool(analysis.summary.strip()) and all(
+        [analysis.key_points, analysis.recommendations, analysis.risks, analysis.next_steps]
+    )
+
+def build_analysis(gemini_response: str) -> AnalysisResponse:
+    """Turn a raw Gemini response into an AnalysisResponse."""
+    sections = parse_ai_response(gemini_response)
+
+    return AnalysisResponse(
+        summary=sections['summary'],
+        key_points=sections['key_points'],
+        recommendations=sections['recommendations'],
+        confidence_score=calculate_confidence(sections),
+        risks=sections['risks'],
+        next_steps=sections['next_steps']
+    )
+
+# A header-only line: optional markdown heading, list marker and bold around a few
+# words with no sentence punctuation, optionally ending with a colon
+_HEADER_LINE_RE = re.compile(
+    r"^(?P<heading>#+\s*)?(?P<marker>(?:[-*•]|\d+[.)])\s+)?(?P<bold>\*\*|__)?\s*"
+    r"(?P<text>[A-Za-z][A-Za-z ,&/'-]*?)\s*(?P<colon>:)?\s*(?:\*\*|__)?\s*(?P<trailing_colon>:)?$"
+)
+_SECTION_KEYWORD_RE = re.compile(
+    r"\b(executive summary|key points|recommendations|risks|next steps)\b",
+    re.IGNORECASE
+)
+MAX_HEADER_WORDS = 5
+_SECTION_MAP = {
+    'executive summary': 'summary',
+    'key points': 'key_points',
+    'recommendations': 'recommendations',
+    'risks': 'risks',
+    'next steps': 'next_steps'
+}
+# Only whole bullet/number markers, so "**bold**" and "1.2 million" survive intact
+_BULLET_RE = re.compile(r"^(?:[•\-*]\s+|\d+[.)]\s+)+")
+
+def match_section_header(line: str) -> Optional[str]:
+    """Return the section a header line starts, or None for content lines."""
+    header = _HEADER_LINE_RE.match(line)
+    if not header or len(header.group('text').split()) > MAX_HEADER_WORDS:
+        return None
+
+    keyword = _SECTION_KEYWORD_RE.search(header.group('text'))
+    if not keyword:
+        return None
+
+    # A plain list item such as "- Budget risks" is content unless it is exactly a header
+    is_emphasized = header.group('heading') or header.group('bold') or \
+        header.group('colon') or header.group('trailing_colon')
+    if header.group('marker') and not is_emphasized and \
+            header.group('text').lower() not in _SECTION_MAP:
+        return None
+
+    return _SECTION_MAP[keyword.group(1).lower()]
+
 def parse_ai_response(content: str) -> Dict[str, any]:
     """Parse the AI response into structured sections."""
     lines = content.split('\n')
@@ -163,21 +394,9 @@ def parse_ai_response(content: str) -> Dict[str, any]:
             continue
 
         # Check for section headers
-        lower_line = line.lower()
-        if 'executive summary' in lower_line:
-            current_section = 'summary'
-            continue
-        elif 'key points' in lower_line:
-            current_section = 'key_points'
-            continue
-        elif 'recommendations' in lower_line:
-            current_section = 'recommendations'
-            continue
-        elif 'risks' in lower_line:
-            current_section = 'risks'
-            continue
-        elif 'next steps' in lower_line:
-            current_section = 'next_steps'
+        section = match_section_header(line)
+        if section:
+            current_section = section
             continue
 
         # Add content to appropriate section
@@ -186,7 +405,7 @@ def parse_ai_response(content: str) -> Dict[str, any]:
                 sections['summary'] += line + ' '
             else:
                 # Remove bullet points and numbers
-                cleaned_line = line.lstrip('•- 1234567890.)')
+                cleaned_line = _BULLET_RE.sub('', line)
                 if cleaned_line:
                     sections[current_section].append(cleaned_line.strip())
 
@@ -213,24 +432,97 @@ def calculate_confidence(sections: Dict) -> int:
 class AnalysisRequest(BaseModel):
     file_id: str
 
+def get_etag(analysis: AnalysisResponse) -> str:
+    """Derive an ETag from the exact body being served."""
+    return f'"{hashlib.blake2b(analysis.model_dump_json().encode(), digest_size=16).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an ETag (weak comparison)."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
 @app.post("/analyze/", response_model=AnalysisResponse)
-async def analyze_document(request: AnalysisRequest):
+async def analyze_document(
+    request: AnalysisRequest,
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
+):
     try:
         file_path = os.path.join(UPLOAD_DIR, request.file_id)
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="File not found")
 
-        # Extract text from document
-        text = extract_text_from_file(file_path)
+        # Same content analyzed by the same model always maps to the same entry
+        cache_key = await run_in_threadpool(get_cache_key, file_path)
+
+        analysis = await run_in_threadpool(get_cached_analysis, cache_key)
+        if analysis is not None:
+            # Only the stored body is stable enough to validate against;
+            # 304 on POST is our own client contract, not RFC 9110 (which asks for 412)
+            etag = get_etag(analysis)
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+            return analysis
+
+        # Extract text from document off the event loop
+        text = await run_in_threadpool(extract_text_from_file, file_path)
 
         # Analyze the text
         analysis = await analyze_text(text)
+        if is_complete(analysis):
+            await run_in_threadpool(store_cached_analysis, cache_key, analysis)
 
         return analysis
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error during document analysis: {str(e)}")  # Log the error for debugging
         raise HTTPException(status_code=500, detail="Error during document analysis")
 
+class BatchAnalysisRequest(BaseModel):
+    file_ids: List[str] = Field(..., max_length=MAX_BATCH_FILES)
+
+@app.post("/analyze_batch/", response_model=List[AnalysisResponse])
+async def analyze_documents(request: BatchAnalysisRequest):
+    try:
+        file_paths = [os.path.join(UPLOAD_DIR, file_id) for file_id in request.file_ids]
+        for file_id, file_path in zip(request.file_ids, file_paths):
+            if not os.path.exists(file_path):
+                raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+
+        cache_keys = await asyncio.gather(
+            *(run_in_threadpool(get_cache_key, path) for path in file_paths)
+        )
+
+        # Repeated file_ids and duplicate content are looked up and analyzed once
+        paths_by_key = dict(zip(cache_keys, file_paths))
+        cached = await asyncio.gather(
+            *(run_in_threadpool(get_cached_analysis, key) for key in paths_by_key)
+        )
+        results = dict(zip(paths_by_key, cached))
+
+        # Only documents without a cached result are sent to Gemini
+        pending = [key for key, analysis in results.items() if analysis is None]
+        if pending:
+            texts = await asyncio.gather(
+                *(run_in_threadpool(extract_text_from_file, paths_by_key[key]) for key in pending)
+            )
+            results.update(zip(pending, await analyze_texts(list(texts))))
+            await asyncio.gather(*(
+                run_in_threadpool(store_cached_analysis, key, results[key])
+                for key in pending if is_complete(results[key])
+            ))
+
+        return [results[key] for key in cache_keys]
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error during batch document analysis: {str(e)}")  # Log the error for debugging
+        raise HTTPException(status_code=500, detail="Error during batch document analysis")
+
 @app.post("/upload/")
 async def upload_file(file: UploadFile = File(...)):
     try:
@@ -246,17 +538,37 @@ async def upload_file(file: UploadFile = File(...)):
         unique_filename = f"{uuid.uuid4()}{file_ext}"
         file_path = os.path.join(UPLOAD_DIR, unique_filename)
 
-        # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Get file size
-        file_size = os.path.getsize(file_path)
+        upload_time = datetime.now().isoformat()
+        partial_path = os.path.join(CONTENT_DIR, f"{uuid.uuid4()}.part")
+        try:
+            # Stream to a temporary name, hashing and counting bytes as we go
+            file_hash = hashlib.blake2b()
+            file_size = 0
+            async with aiofiles.open(partial_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    file_hash.update(chunk)
+                    file_size += len(chunk)
+                    await buffer.write(chunk)
+            content_hash = file_hash.hexdigest()
+            content_path = os.path.join(CONTENT_DIR, content_hash)
+
+            # New content is published atomically; duplicates reuse the stored copy
+            if not os.path.exists(content_path):
+                os.replace(partial_path, content_path)
+            os.link(content_path, file_path)
+        finally:
+            # Left behind by duplicate content or a failed write/link
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+        # Hardlinks share one inode (and its ctime), so upload time is kept in the table
+        await run_in_threadpool(record_upload, unique_filename, content_hash, upload_time)
 
         return {
             "filename": file.filename,
             "file_id": unique_filename,
-            "upload_time": datetime.now().isoformat(),
+            "content_hash": content_hash,
+            "upload_time": upload_time,
             "file_size": file_size
         }
 
@@ -266,11 +578,16 @@ async def upload_file(file: UploadFile = File(...)):
 @app.get("/files/")
 async def list_files():
     files = []
+    upload_times = await run_in_threadpool(get_upload_times)
     for filename in os.listdir(UPLOAD_DIR):
         file_path = os.path.join(UPLOAD_DIR, filename)
+        if not os.path.isfile(file_path):
+            continue
         files.append({
             "filename": filename,
-            "upload_time": datetime.fromtimestamp(os.path.getctime(file_path)).isoformat(),
+            # Files uploaded before upload times were recorded fall back to ctime
+            "upload_time": upload_times.get(filename)
+                or datetime.fromtimestamp(os.path.getctime(file_path)).isoformat(),
             "file_size": os.path.getsize(file_path)
         })
     return files
\ No newline at end of file